@@ -20,7 +20,6 @@ fi
 
 tar_file=$(realpath "$1")
 sub_tdir=$(mktemp -d "${tar_file%.tar}.sub.XXXXXXXX")
-sub_file="${sub_tdir}/submodule.tar"
 
 # We want a predictable list of submodules for builds, that is
 # independent of what the developer currently has initialized
@@ -28,9 +27,15 @@ sub_file="${sub_tdir}/submodule.tar"
 # different to the host OS.
 submodules="dtc slirp ui/keycodemapdb tests/fp/berkeley-softfloat-3 tests/fp/berkeley-testfloat-3"
 sub_deinit=""
+bg_pids=""
 
 function cleanup() {
     local status=$?
+    # Stop any archive jobs still writing into $sub_tdir before removing it
+    if test "$bg_pids" != ""; then
+        kill $bg_pids 2>/dev/null
+        wait $bg_pids 2>/dev/null
+    fi
     rm -rf "$sub_tdir"
     if test "$sub_deinit" != ""; then
         git submodule deinit $sub_deinit
@@ -48,12 +53,8 @@ function tree_ish() {
     echo "$retval"
 }
 
-git archive --format tar "$(tree_ish)" > "$tar_file"
-test $? -ne 0 && error "failed to archive qemu"
 for sm in $submodules; do
     status="$(git submodule status "$sm")"
-    smhash="${status#[ +-]}"
-    smhash="${smhash%% *}"
     case "$status" in
         -*)
             sub_deinit="$sub_deinit $sm"
@@ -64,9 +65,32 @@ for sm in $submodules; do
             echo "WARNING: submodule $sm is out of sync"
             ;;
     esac
-    (cd $sm; git archive --format tar --prefix "$sm/" $(tree_ish)) > "$sub_file"
+done
+
+# Archive qemu and all submodules concurrently, then concatenate in order
+git archive --format tar "$(tree_ish)" > "$tar_file" &
+qemu_pid=$!
+bg_pids=$qemu_pid
+sub_pids=""
+for sm in $submodules; do
+    (cd $sm; exec git archive --format tar --prefix "$sm/" $(tree_ish)) \
+        > "${sub_tdir}/$(echo "$sm" | tr / _).tar" &
+    sub_pids="$sub_pids $!"
+done
+bg_pids="$bg_pids $sub_pids"
+
+wait $qemu_pid
+test $? -ne 0 && error "failed to archive qemu"
+set -- $sub_pids
+for sm in $submodules; do
+    status="$(git submodule status "$sm")"
+    smhash="${status#[ +-]}"
+    smhash="${smhash%% *}"
+    wait $1
     test $? -ne 0 && error "failed to archive submodule $sm ($smhash)"
-    tar --concatenate --file "$tar_file" "$sub_file"
+    shift
+    tar --concatenate --file "$tar_file" "${sub_tdir}/$(echo "$sm" | tr / _).tar"
     test $? -ne 0 && error "failed append submodule $sm to $tar_file"
 done
+bg_pids=""
 exit 0
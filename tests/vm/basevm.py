@@ -19,24 +19,112 @@ import sys
 import socket
 import logging
 import time
-import datetime
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'python'))
 from qemu.accel import kvm_available
 from qemu.machine import QEMUMachine
 import subprocess
+import shlex
 import hashlib
+import functools
+import mmap
 import optparse
 import atexit
 import tempfile
+import concurrent.futures
 import shutil
-import multiprocessing
 import traceback
+try:
+    import paramiko
+    PARAMIKO_AVAILABLE = True
+except ImportError:
+    PARAMIKO_AVAILABLE = False
 
 SSH_KEY = open(os.path.join(os.path.dirname(__file__),
                "..", "keys", "id_rsa")).read()
 SSH_PUB_KEY = open(os.path.join(os.path.dirname(__file__),
                    "..", "keys", "id_rsa.pub")).read()
 
+# Default number of guest vCPUs under KVM
+_HALF_CPUS = max(1, (os.cpu_count() or 2) // 2)
+
+# Host port of the ssh forward in 'info usernet' output
+_HOSTFWD_RE = re.compile(r"TCP\[HOST_FORWARD\]\s+\S+\s+\S+\s+(\d+)\s+\S+\s+22\b")
+
+def _qemu_has_io_uring(qemu_bin):
+    """Check that qemu_bin can open a file with aio=io_uring on this host.
+    This needs QEMU 5.0 or later built with liburing, and a kernel that
+    lets it set up io_uring (not disabled by sysctl or seccomp)."""
+    try:
+        with QEMUMachine(binary=qemu_bin, args=["-nodefaults"]) as vm:
+            vm.set_machine("none")
+            vm.launch()
+            r = vm.qmp("blockdev-add", node_name="probe", driver="file",
+                       filename=os.devnull, aio="io_uring")
+    except Exception as e:
+        logging.debug("Cannot probe %s for io_uring support: %s", qemu_bin, e)
+        return False
+    if "error" in r:
+        logging.debug("%s cannot use io_uring: %s", qemu_bin,
+                      r["error"].get("desc"))
+        return False
+    return True
+
+def _hugepages_available(npages):
+    try:
+        with open("/sys/kernel/mm/hugepages/hugepages-2048kB/"
+                  "free_hugepages") as f:
+            return int(f.read()) >= npages
+    except (OSError, ValueError):
+        return False
+
+@functools.lru_cache(maxsize=1024)
+def _url_key(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+@functools.lru_cache(maxsize=1024)
+def _dir_key(path):
+    return hashlib.sha1(path.encode("utf-8")).hexdigest()[:5]
+
+def _file_digest(fname, alg):
+    h = hashlib.new(alg)
+    with open(fname, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                h.update(mm)
+        except (ValueError, OSError):
+            # empty file, or the mapping failed: hash in 4 MiB chunks
+            for chunk in iter(lambda: f.read(4 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+def _write_file(path, data, mode):
+    """Create path with the given permissions from the start."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+                 mode)
+    try:
+        os.write(fd, data.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+def _checksum_cache_path(fname, alg="sha256"):
+    return fname + ".%s.cache" % alg
+
+def _checksum_cached(fname, alg, checksum):
+    """Return True if fname was already verified against checksum and
+    has not been modified since."""
+    try:
+        with open(_checksum_cache_path(fname, alg)) as f:
+            mtime, digest = f.read().split()
+    except (OSError, ValueError):
+        return False
+    return int(mtime) == os.stat(fname).st_mtime_ns and digest == checksum
+
+def _checksum_cache_store(fname, alg, checksum):
+    cache = _checksum_cache_path(fname, alg)
+    with open(cache + ".tmp", "w") as f:
+        f.write("%d %s\n" % (os.stat(fname).st_mtime_ns, checksum))
+    os.replace(cache + ".tmp", cache)
+
 class BaseVM(object):
     GUEST_USER = "qemu"
     GUEST_PASS = "qemupass"
@@ -59,80 +147,227 @@ class BaseVM(object):
     poweroff = "poweroff"
     # enable IPv6 networking
     ipv6 = True
-    def __init__(self, debug=False, vcpus=None):
+    # Guest RAM size in MiB
+    _MEM_MB = 4096
+    # QEMU arguments common to every guest
+    _BASE_ARGS = (
+        "-nodefaults", "-m", "%dM" % _MEM_MB,
+        "-cpu", "max",
+        "-device", "virtio-net-pci,netdev=vnet")
+    # Guest RAM backed by 2M hugepages
+    _HUGEPAGE_ARGS = (
+        "-object", "memory-backend-memfd,id=mem,size=%dM,"
+                   "hugetlb=on,hugetlbsize=2M" % _MEM_MB,
+        "-numa", "node,memdev=mem")
+    # Remote command for _ssh_script(), valid in both sh and csh
+    _SH_SCRIPT = ("sh -c 'f=`mktemp` && cat >\"$f\" && "
+                  "sh -e \"$f\" </dev/null; r=$?; rm -f \"$f\"; exit $r'")
+    # Per-VM ssh_config, written by boot() once the forwarded port is known
+    SSH_CONFIG = """Host vm
+  HostName 127.0.0.1
+  Port {port}
+  User {user}
+  IdentityFile "{keyfile}"
+  StrictHostKeyChecking no
+  UserKnownHostsFile /dev/null
+  ConnectTimeout 1
+  ControlMaster auto
+  ControlPath "{muxdir}/cm-%C"
+  ControlPersist 60
+{sendenv}"""
+    # -drive AIO backend per QEMU binary, probed once by _drive_aio()
+    _aio = {}
+    def __init__(self, debug=False, vcpus=None, safe_cache=False):
         self._guest = None
         self._tmpdir = os.path.realpath(tempfile.mkdtemp(prefix="vm-test-",
                                                          suffix=".tmp",
                                                          dir="."))
         atexit.register(shutil.rmtree, self._tmpdir)
+        # ssh control sockets must fit in sun_path (108 bytes), so they can't
+        # live under the possibly deep build directory
+        self._ssh_mux_dir = tempfile.mkdtemp(prefix="vm-ssh-", dir="/tmp")
+        atexit.register(shutil.rmtree, self._ssh_mux_dir)
 
         self._ssh_key_file = os.path.join(self._tmpdir, "id_rsa")
-        open(self._ssh_key_file, "w").write(SSH_KEY)
-        subprocess.check_call(["chmod", "600", self._ssh_key_file])
+        _write_file(self._ssh_key_file, SSH_KEY, 0o600)
 
         self._ssh_pub_key_file = os.path.join(self._tmpdir, "id_rsa.pub")
-        open(self._ssh_pub_key_file, "w").write(SSH_PUB_KEY)
+        _write_file(self._ssh_pub_key_file, SSH_PUB_KEY, 0o644)
 
         self.debug = debug
-        self._stderr = sys.stderr
-        self._devnull = open(os.devnull, "w")
-        if self.debug:
-            self._stdout = sys.stdout
-        else:
-            self._stdout = self._devnull
-        self._args = [ \
-            "-nodefaults", "-m", "4G",
-            "-cpu", "max",
+        self._safe_cache = safe_cache
+        # None inherits our stdout
+        self._stdout = None if self.debug else subprocess.DEVNULL
+        self._args = list(self._BASE_ARGS) + [
             "-netdev", "user,id=vnet,hostfwd=:127.0.0.1:0-:22" +
-                       (",ipv6=no" if not self.ipv6 else ""),
-            "-device", "virtio-net-pci,netdev=vnet",
-            "-vnc", "127.0.0.1:0,to=20"]
+                       (",ipv6=no" if not self.ipv6 else "")]
+        # Only debug runs need a VNC server to watch the guest
+        if self.debug:
+            self._args += ["-vnc", "127.0.0.1:0,to=20"]
         if vcpus and vcpus > 1:
             self._args += ["-smp", "%d" % vcpus]
+        # Serve virtio-blk from a dedicated iothread, one queue per vCPU
+        self._blk_opts = ""
+        if vcpus:
+            self._args += ["-object", "iothread,id=io0"]
+            self._blk_opts = ",iothread=io0,num-queues=%d" % vcpus
         if kvm_available(self.arch):
             self._args += ["-enable-kvm"]
         else:
             logging.info("KVM not available, not using -enable-kvm")
         self._data_args = []
+        # paramiko clients by user, None until wait_ssh() sees the guest up
+        self._ssh_clients = None
+
+    def _qemu_bin(self):
+        return os.environ.get("QEMU", "qemu-system-" + self.arch)
+
+    def _drive_aio(self):
+        qemu_bin = self._qemu_bin()
+        if qemu_bin not in BaseVM._aio:
+            if _qemu_has_io_uring(qemu_bin):
+                BaseVM._aio[qemu_bin] = "io_uring"
+            else:
+                BaseVM._aio[qemu_bin] = "threads"
+        return BaseVM._aio[qemu_bin]
 
     def _download_with_cache(self, url, sha256sum=None, sha512sum=None):
+        """Download url into the cache and return the cached file name.
+
+        url may also be a list of URLs, in which case they are fetched
+        in parallel and a list of file names is returned; sha256sum and
+        sha512sum are then lists too (or None)."""
+        if isinstance(url, str):
+            return self._download_one(url, sha256sum, sha512sum)
+        n = len(url)
+        if len(set(url)) != n:
+            raise ValueError("Duplicate URLs would share a download file")
+        sha256sums = sha256sum or [None] * n
+        sha512sums = sha512sum or [None] * n
+        if len(sha256sums) != n or len(sha512sums) != n:
+            raise ValueError("Need one checksum per URL")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, n)) as ex:
+            return list(ex.map(self._download_one, url,
+                               sha256sums, sha512sums))
+
+    def _download_one(self, url, sha256sum, sha512sum):
         def check_sha256sum(fname):
             if not sha256sum:
                 return True
-            checksum = subprocess.check_output(["sha256sum", fname]).split()[0]
-            return sha256sum == checksum.decode("utf-8")
+            if _checksum_cached(fname, "sha256", sha256sum):
+                return True
+            if sha256sum != _file_digest(fname, "sha256"):
+                return False
+            _checksum_cache_store(fname, "sha256", sha256sum)
+            return True
 
         def check_sha512sum(fname):
             if not sha512sum:
                 return True
-            checksum = subprocess.check_output(["sha512sum", fname]).split()[0]
-            return sha512sum == checksum.decode("utf-8")
+            if _checksum_cached(fname, "sha512", sha512sum):
+                return True
+            if sha512sum != _file_digest(fname, "sha512"):
+                return False
+            _checksum_cache_store(fname, "sha512", sha512sum)
+            return True
 
         cache_dir = os.path.expanduser("~/.cache/qemu-vm/download")
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
-        fname = os.path.join(cache_dir,
-                             hashlib.sha1(url.encode("utf-8")).hexdigest())
+        os.makedirs(cache_dir, exist_ok=True)
+        fname = os.path.join(cache_dir, _url_key(url))
         if os.path.exists(fname) and check_sha256sum(fname) and check_sha512sum(fname):
             return fname
         logging.debug("Downloading %s to %s...", url, fname)
         subprocess.check_call(["wget", "-c", url, "-O", fname + ".download"],
-                              stdout=self._stdout, stderr=self._stderr)
-        os.rename(fname + ".download", fname)
+                              stdout=self._stdout)
+        os.replace(fname + ".download", fname)
         return fname
 
-    def _ssh_do(self, user, cmd, check):
-        ssh_cmd = ["ssh", "-q", "-t",
-                   "-o", "StrictHostKeyChecking=no",
-                   "-o", "UserKnownHostsFile=" + os.devnull,
-                   "-o", "ConnectTimeout=1",
-                   "-p", self.ssh_port, "-i", self._ssh_key_file]
-        for var in self.envvars:
-            ssh_cmd += ['-o', "SendEnv=%s" % var ]
-        assert not isinstance(cmd, str)
-        ssh_cmd += ["%s@127.0.0.1" % user] + list(cmd)
-        logging.debug("ssh_cmd: %s", " ".join(ssh_cmd))
-        r = subprocess.call(ssh_cmd)
+    def _ssh_client(self, user):
+        """Return a connected paramiko client for user, or None if the
+        guest is not known to be up or paramiko is unavailable."""
+        if not PARAMIKO_AVAILABLE or self._ssh_clients is None:
+            return None
+        # False records a failed connect, don't retry it on every command
+        client = self._ssh_clients.get(user)
+        if client is False:
+            return None
+        if client:
+            if client.get_transport() and client.get_transport().is_active():
+                return client
+            client.close()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect("127.0.0.1", port=int(self.ssh_port),
+                           username=user, key_filename=self._ssh_key_file,
+                           look_for_keys=False, allow_agent=False)
+        except (paramiko.SSHException, OSError) as e:
+            logging.debug("paramiko connect failed, using ssh: %s", e)
+            self._ssh_clients[user] = False
+            return None
+        self._ssh_clients[user] = client
+        return client
+
+    def _ssh_close(self):
+        for client in (self._ssh_clients or {}).values():
+            if client:
+                client.close()
+        self._ssh_clients = None
+
+    def _ssh_start(self, client, cmd):
+        chan = client.get_transport().open_session()
+        chan.update_environment({var: os.environ[var] for var in self.envvars
+                                 if var in os.environ})
+        # like ssh -t, interleave stderr with stdout
+        chan.set_combine_stderr(True)
+        # ssh joins the remote argv with spaces, do the same
+        chan.exec_command(" ".join(cmd))
+        return chan
+
+    def _ssh_finish(self, chan, stdin=None):
+        try:
+            if stdin is not None:
+                chan.sendall(stdin)
+            chan.shutdown_write()
+            for data in iter(lambda: chan.recv(1 << 16), b""):
+                sys.stdout.buffer.write(data)
+                sys.stdout.flush()
+            r = chan.recv_exit_status()
+        except (paramiko.SSHException, OSError) as e:
+            logging.debug("paramiko session lost: %s", e)
+            r = -1
+        chan.close()
+        # connection lost, report it the way ssh does
+        return 255 if r == -1 else r
+
+    def _ssh_do(self, user, cmd, check, stdin=None, batch=False):
+        log = logging.getLogger()
+        # Only scripted batch commands go over paramiko; anything that may
+        # be interactive keeps ssh -t for a tty, stdin and SIGHUP on ^C
+        client = self._ssh_client(user) if batch and cmd else None
+        if client:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("ssh_cmd (paramiko): %s", " ".join(cmd))
+            try:
+                chan = self._ssh_start(client, cmd)
+            except (paramiko.SSHException, OSError) as e:
+                # The command has not started, so ssh can safely run it
+                logging.debug("paramiko session failed, using ssh: %s", e)
+                # Reconnect on the next command rather than right away
+                client.close()
+                del self._ssh_clients[user]
+                client = None
+            else:
+                r = self._ssh_finish(chan, stdin)
+        if not client:
+            # No tty when feeding stdin, or ssh would complain about it
+            ssh_cmd = ["ssh", "-F", self._ssh_config, "-q",
+                       "-t" if stdin is None else "-T", "%s@vm" % user]
+            ssh_cmd += cmd
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("ssh_cmd: %s",
+                          " ".join(shlex.quote(a) for a in ssh_cmd))
+            r = subprocess.run(ssh_cmd, input=stdin).returncode
         if check and r != 0:
             raise Exception("SSH command failed: %s" % cmd)
         return r
@@ -144,10 +379,25 @@ class BaseVM(object):
         return self._ssh_do("root", cmd, False)
 
     def ssh_check(self, *cmd):
-        self._ssh_do(self.GUEST_USER, cmd, True)
+        self._ssh_do(self.GUEST_USER, cmd, True, batch=True)
 
     def ssh_root_check(self, *cmd):
-        self._ssh_do("root", cmd, True)
+        self._ssh_do("root", cmd, True, batch=True)
+
+    def _ssh_script(self, user, lines):
+        # Run all lines in a single remote sh, stopping at the first error.
+        # The script goes over stdin so that neither the login shell (csh
+        # for root on FreeBSD) nor its quoting rules ever see it; it is
+        # saved to a file first so the commands don't consume it.
+        script = "\n".join(lines) + "\n"
+        self._ssh_do(user, (self._SH_SCRIPT,), True,
+                     stdin=script.encode("utf-8"), batch=True)
+
+    def ssh_script(self, *lines):
+        self._ssh_script(self.GUEST_USER, lines)
+
+    def ssh_root_script(self, *lines):
+        self._ssh_script("root", lines)
 
     def build_image(self, img):
         raise NotImplementedError
@@ -158,50 +408,78 @@ class BaseVM(object):
         subprocess.check_call(cmd)
 
     def add_source_dir(self, src_dir):
-        name = "data-" + hashlib.sha1(src_dir.encode("utf-8")).hexdigest()[:5]
+        name = "data-" + _dir_key(src_dir)
         tarfile = os.path.join(self._tmpdir, name + ".tar")
         logging.debug("Creating archive %s for src_dir dir: %s", tarfile, src_dir)
         subprocess.check_call(["./scripts/archive-source.sh", tarfile],
-                              cwd=src_dir, stdin=self._devnull,
-                              stdout=self._stdout, stderr=self._stderr)
+                              cwd=src_dir, stdin=subprocess.DEVNULL,
+                              stdout=self._stdout)
         self._data_args += ["-drive",
-                            "file=%s,if=none,id=%s,cache=writeback,format=raw" % \
-                                    (tarfile, name),
+                            "file=%s,if=none,id=%s,cache=writeback,aio=%s,format=raw" % \
+                                    (tarfile, name, self._drive_aio()),
                             "-device",
-                            "virtio-blk,drive=%s,serial=%s,bootindex=1" % (name, name)]
+                            "virtio-blk,drive=%s,serial=%s,bootindex=1%s" % \
+                                    (name, name, self._blk_opts)]
 
     def boot(self, img, extra_args=[]):
+        # Writes to a snapshot overlay are thrown away, so don't flush them
+        if "snapshot=on" in img and not self._safe_cache:
+            cache = "unsafe"
+        else:
+            cache = "writeback"
         args = self._args + [
             "-device", "VGA",
-            "-drive", "file=%s,if=none,id=drive0,cache=writeback" % img,
-            "-device", "virtio-blk,drive=drive0,bootindex=0"]
+            "-drive", "file=%s,if=none,id=drive0,cache=%s,aio=%s" % \
+                    (img, cache, self._drive_aio()),
+            "-device", "virtio-blk,drive=drive0,bootindex=0" + self._blk_opts]
         args += self._data_args + extra_args
+        qemu_bin = self._qemu_bin()
+        # Back guest RAM with 2M pages if enough are free.  This is best
+        # effort: other VMs may grab the pages before we start.
+        guest = None
+        if _hugepages_available(self._MEM_MB // 2):
+            try:
+                guest = self._launch(qemu_bin,
+                                     args + list(self._HUGEPAGE_ARGS),
+                                     quiet=True)
+            except Exception:
+                logging.info("Failed to launch QEMU with hugepages, "
+                             "retrying without")
+        if guest is None:
+            guest = self._launch(qemu_bin, args)
+        atexit.register(self.shutdown)
+        self._guest = guest
+        usernet_info = guest.qmp("human-monitor-command",
+                                 command_line="info usernet")
+        m = _HOSTFWD_RE.search(usernet_info["return"])
+        if not m:
+            raise Exception("Cannot find ssh port from 'info usernet':\n%s" % \
+                            usernet_info)
+        self.ssh_port = m.group(1)
+        self._ssh_config = os.path.join(self._tmpdir, "ssh_config")
+        _write_file(self._ssh_config, self.SSH_CONFIG.format(
+            port=self.ssh_port, user=self.GUEST_USER,
+            keyfile=self._ssh_key_file, muxdir=self._ssh_mux_dir,
+            sendenv="".join("  SendEnv %s\n" % var for var in self.envvars)),
+            0o600)
+
+    def _launch(self, qemu_bin, args, quiet=False):
         logging.debug("QEMU args: %s", " ".join(args))
-        qemu_bin = os.environ.get("QEMU", "qemu-system-" + self.arch)
         guest = QEMUMachine(binary=qemu_bin, args=args)
         guest.set_machine('pc')
         guest.set_console()
         try:
             guest.launch()
         except:
+            if quiet:
+                raise
             logging.error("Failed to launch QEMU, command line:")
             logging.error(" ".join([qemu_bin] + args))
             logging.error("Log:")
             logging.error(guest.get_log())
             logging.error("QEMU version >= 2.10 is required")
             raise
-        atexit.register(self.shutdown)
-        self._guest = guest
-        usernet_info = guest.qmp("human-monitor-command",
-                                 command_line="info usernet")
-        self.ssh_port = None
-        for l in usernet_info["return"].splitlines():
-            fields = l.split()
-            if "TCP[HOST_FORWARD]" in fields and "22" in fields:
-                self.ssh_port = l.split()[3]
-        if not self.ssh_port:
-            raise Exception("Cannot find ssh port from 'info usernet':\n%s" % \
-                            usernet_info)
+        return guest
 
     def console_init(self, timeout = 120):
         vm = self._guest
@@ -306,20 +584,21 @@ class BaseVM(object):
         sys.stderr.write("### %s ...\n" % text)
 
     def wait_ssh(self, seconds=300):
-        starttime = datetime.datetime.now()
-        endtime = starttime + datetime.timedelta(seconds=seconds)
-        guest_up = False
-        while datetime.datetime.now() < endtime:
+        self._ssh_close()
+        deadline = time.monotonic() + seconds
+        delay = 0.1
+        while time.monotonic() < deadline:
             if self.ssh("exit 0") == 0:
-                guest_up = True
                 break
-            seconds = (endtime - datetime.datetime.now()).total_seconds()
-            logging.debug("%ds before timeout", seconds)
-            time.sleep(1)
-        if not guest_up:
+            logging.debug("%ds before timeout", deadline - time.monotonic())
+            time.sleep(delay)
+            delay = min(2.0, delay * 1.5)
+        else:
             raise Exception("Timeout while waiting for guest ssh")
+        self._ssh_clients = {}
 
     def shutdown(self):
+        self._ssh_close()
         self._guest.shutdown()
 
     def wait(self):
@@ -327,6 +606,7 @@ class BaseVM(object):
 
     def graceful_shutdown(self):
         self.ssh_root(self.poweroff)
+        self._ssh_close()
         self._guest.wait()
 
     def qmp(self, *args, **kwargs):
@@ -336,7 +616,7 @@ def parse_args(vmcls):
 
     def get_default_jobs():
         if kvm_available(vmcls.arch):
-            return multiprocessing.cpu_count() // 2
+            return _HALF_CPUS
         else:
             return 1
 
@@ -366,6 +646,9 @@ def parse_args(vmcls):
                       help="Interactively run command")
     parser.add_option("--snapshot", "-s", action="store_true",
                       help="run tests with a snapshot")
+    parser.add_option("--safe-cache", action="store_true",
+                      help="use cache=writeback rather than cache=unsafe "
+                           "for snapshot boots")
     parser.disable_interspersed_args()
     return parser.parse_args()
 
@@ -377,7 +660,8 @@ def main(vmcls):
             return 1
         logging.basicConfig(level=(logging.DEBUG if args.debug
                                    else logging.WARN))
-        vm = vmcls(debug=args.debug, vcpus=args.jobs)
+        vm = vmcls(debug=args.debug, vcpus=args.jobs,
+                   safe_cache=args.safe_cache)
         if args.build_image:
             if os.path.exists(args.image) and not args.force:
                 sys.stderr.writelines(["Image file exists: %s\n" % args.image,